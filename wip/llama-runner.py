@@ -1,31 +1,324 @@
 #!/usr/bin/env python3
 import argparse
+import http.client
+import json
+import signal
+import socket
 import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 HOME_DIR = Path.home()
 MODEL_DIR = Path("/srv/vmstore/models")
 LLAMA_BIN = HOME_DIR / "Projects/llama.cpp/build/bin/llama-server"
 
+# Headers that only make sense for a single hop and must not be forwarded
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "upgrade",
+               "proxy-authorization", "proxy-authenticate", "trailer", "host"}
+
+# Endpoints that are allowed to start a backend
+INFERENCE_PATHS = {"/completion", "/completions", "/v1/completions", "/chat/completions",
+                   "/v1/chat/completions", "/infill", "/embedding", "/embeddings", "/v1/embeddings",
+                   "/rerank", "/reranking", "/v1/rerank", "/v1/reranking", "/tokenize", "/detokenize",
+                   "/apply-template"}
+
 parser = argparse.ArgumentParser(description="Run llama-server with named arguments")
-parser.add_argument("--model", "-m", required=True, help="Model path (relative to MODEL_DIR)")
+parser.add_argument("--model", "-m", help="Model path (relative to MODEL_DIR); default model in on-demand mode")
 parser.add_argument("--ctx", "-c", type=int, default=32768, help="Context size")
 parser.add_argument("--port", "-p", type=int, default=7777, help="Port number")
+parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
 parser.add_argument("--threads", "-t", type=int, default=15, help="Number of CPU threads")
 parser.add_argument("--gpu", "-g", type=int, default=0, help="Number of layers to offload to GPU")
+parser.add_argument("--on-demand", "-o", action="store_true",
+                    help="Listen on --port and start llama-server per model on first request")
+parser.add_argument("--idle", "-i", type=int, default=600,
+                    help="Seconds a backend may sit idle before it is shut down (on-demand mode)")
+parser.add_argument("--max-loaded", type=int, default=1,
+                    help="Maximum backends kept running at once (on-demand mode)")
+parser.add_argument("--start-timeout", type=int, default=600,
+                    help="Seconds to wait for a backend to become healthy (on-demand mode)")
 
 args = parser.parse_args()
 
-cmd = [
-    str(LLAMA_BIN),
-    "-m", str(MODEL_DIR / args.model),
-    "--ctx-size", str(args.ctx),
-    "--n-gpu-layers", str(args.gpu),
-    "--no-kv-offload",
-    "--threads", str(args.threads),
-    "--port", str(args.port),
-    "--jinja"
-]
-
-print("Running:", " ".join(cmd))
-subprocess.run(cmd, check=True)
+
+def build_cmd(model, port, host=None):
+    cmd = [
+        str(LLAMA_BIN),
+        "-m", str(MODEL_DIR / model),
+        "--ctx-size", str(args.ctx),
+        "--n-gpu-layers", str(args.gpu),
+        "--no-kv-offload",
+        "--threads", str(args.threads),
+        "--port", str(port),
+        "--jinja"
+    ]
+    if host:
+        cmd += ["--host", host]
+    return cmd
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def list_models():
+    return sorted(str(p.relative_to(MODEL_DIR)) for p in MODEL_DIR.rglob("*.gguf"))
+
+
+def resolve_model(name):
+    # Accept a path relative to MODEL_DIR, a file name, or a file name without .gguf.
+    # Only files found under MODEL_DIR match, so clients can't point -m at arbitrary paths.
+    if not name:
+        return args.model
+    for model in list_models():
+        path = Path(model)
+        if name in (model, path.name, path.stem):
+            return model
+    return None
+
+
+class Backend:
+    def __init__(self, model):
+        self.model = model
+        self.port = None
+        self.proc = None
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def healthy(self):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=2)
+            conn.request("GET", "/health")
+            status = conn.getresponse().status
+            conn.close()
+            return status == 200
+        except OSError:
+            return False
+
+    def start(self):
+        self.port = free_port()
+        cmd = build_cmd(self.model, self.port, host="127.0.0.1")
+        print("Starting:", " ".join(cmd), flush=True)
+        self.proc = subprocess.Popen(cmd)
+        deadline = time.monotonic() + args.start_timeout
+        while time.monotonic() < deadline:
+            if not self.running():
+                raise RuntimeError(f"llama-server for {self.model} exited with {self.proc.returncode}")
+            if self.healthy():
+                return
+            time.sleep(0.5)
+        self.stop()
+        raise RuntimeError(f"llama-server for {self.model} not healthy after {args.start_timeout}s")
+
+    def stop(self):
+        if not self.running():
+            return
+        print(f"Stopping {self.model} (port {self.port})", flush=True)
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class Manager:
+    def __init__(self):
+        self.backends = {}
+        self.hits = {}
+        self.cold_starts = {}
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+
+    def acquire(self, model, start=True):
+        with self.lock:
+            backend = self.backends.setdefault(model, Backend(model))
+            backend.active += 1
+            if start:
+                self.hits[model] = self.hits.get(model, 0) + 1
+
+        try:
+            with backend.lock:
+                if backend.running():
+                    return backend
+            if not start:
+                raise RuntimeError(f"{model} is not loaded")
+
+            # Starts are serialized, so the slot count in make_room() includes any backend being started
+            with self.start_lock:
+                with backend.lock:
+                    if backend.running():
+                        return backend
+                self.make_room(keep=model)
+                with backend.lock:
+                    began = time.monotonic()
+                    backend.start()
+                    elapsed = time.monotonic() - began
+                with self.lock:
+                    self.cold_starts.setdefault(model, []).append(elapsed)
+                print(f"Cold start {model}: {elapsed:.1f}s", flush=True)
+            return backend
+        except Exception:
+            self.release(backend, touch=False)
+            raise
+
+    def release(self, backend, touch=True):
+        with self.lock:
+            backend.active -= 1
+            if touch:
+                backend.last_used = time.monotonic()
+
+    def make_room(self, keep):
+        # Stop least recently used idle backends until one more fits under --max-loaded,
+        # waiting for busy ones to go idle rather than exceeding the cap
+        deadline = time.monotonic() + args.start_timeout
+        while True:
+            with self.lock:
+                loaded = [b for b in self.backends.values() if b.model != keep and b.running()]
+                loaded.sort(key=lambda b: b.last_used)
+                excess = len(loaded) + 1 - args.max_loaded
+                victims = [b for b in loaded if b.active == 0][:max(0, excess)]
+            if excess <= 0:
+                return
+            for backend in victims:
+                with backend.lock:
+                    if backend.active == 0:
+                        backend.stop()
+            if victims:
+                continue
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"No free slot for {keep}: {len(loaded)} busy backend(s) loaded")
+            time.sleep(0.5)
+
+    def reap(self):
+        while True:
+            time.sleep(5)
+            now = time.monotonic()
+            with self.lock:
+                idle = [b for b in self.backends.values()
+                        if b.running() and b.active == 0 and now - b.last_used > args.idle]
+            for backend in idle:
+                with backend.lock:
+                    if backend.active == 0:
+                        backend.stop()
+
+    def stats(self):
+        with self.lock:
+            return {
+                model: {
+                    "hits": hits,
+                    "loaded": self.backends[model].running(),
+                    "cold_starts": len(self.cold_starts.get(model, [])),
+                    "avg_cold_start_s": round(sum(self.cold_starts[model]) / len(self.cold_starts[model]), 2)
+                    if self.cold_starts.get(model) else None,
+                }
+                for model, hits in self.hits.items()
+            }
+
+    def shutdown(self):
+        for backend in list(self.backends.values()):
+            backend.stop()
+
+
+manager = Manager()
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def proxy(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+
+        # Answer polling endpoints here so health checks never load a model
+        path = self.path.split("?", 1)[0]
+        if self.command == "GET" and path == "/runner/stats":
+            return self.send_json(200, manager.stats())
+        if self.command == "GET" and path == "/health":
+            return self.send_json(200, {"status": "ok"})
+        if self.command == "GET" and path in ("/v1/models", "/models"):
+            return self.send_json(200, {"object": "list", "data": [
+                {"id": m, "object": "model", "owned_by": "llamacpp"} for m in list_models()]})
+
+        name = None
+        if body:
+            try:
+                name = json.loads(body).get("model")
+            except (ValueError, AttributeError):
+                pass
+        if name is not None and not isinstance(name, str):
+            return self.send_json(400, {"error": {"message": "model must be a string"}})
+        model = resolve_model(name)
+        if model is None:
+            return self.send_json(404, {"error": {"message": f"Unknown model: {name or '(none)'}"}})
+
+        # Only inference endpoints may cold-start a model; anything else (/props, /slots, ...)
+        # is forwarded to a backend that is already running
+        start = path in INFERENCE_PATHS
+        try:
+            backend = manager.acquire(model, start=start)
+        except (RuntimeError, OSError) as e:
+            return self.send_json(503, {"error": {"message": str(e)}})
+
+        sent = False
+        try:
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_HEADERS}
+            conn = http.client.HTTPConnection("127.0.0.1", backend.port)
+            conn.request(self.command, self.path, body=body, headers=headers)
+            resp = conn.getresponse()
+            sent = True
+            self.send_response(resp.status, resp.reason)
+            for k, v in resp.getheaders():
+                if k.lower() not in HOP_HEADERS:
+                    self.send_header(k, v)
+            self.end_headers()
+            # Stream chunk by chunk so SSE completions reach the client as they arrive
+            while chunk := resp.read1(65536):
+                self.wfile.write(chunk)
+                self.wfile.flush()
+            conn.close()
+        except (OSError, http.client.HTTPException) as e:
+            print(f"Proxy error for {model}: {e}", flush=True)
+            if not sent:
+                self.send_json(502, {"error": {"message": f"Backend for {model} failed: {e}"}})
+        finally:
+            manager.release(backend, touch=start)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = proxy
+
+
+if args.on_demand:
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    threading.Thread(target=manager.reap, daemon=True).start()
+    # Exit through the finally below on SIGTERM (systemd, kill) so backends are not orphaned
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Listening on {args.host}:{args.port}, models from {MODEL_DIR}, idle unload after {args.idle}s", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        manager.shutdown()
+        print(json.dumps(manager.stats(), indent=2))
+else:
+    if not args.model:
+        parser.error("--model is required unless --on-demand is set")
+    cmd = build_cmd(args.model, args.port, host=args.host)
+    print("Running:", " ".join(cmd))
+    subprocess.run(cmd, check=True)